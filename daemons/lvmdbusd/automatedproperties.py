@@ -70,8 +70,8 @@ class AutomatedProperties(dbus.service.Object):
 		value = getattr(obj, property_name)
 		# Note: If we get an exception in this handler we won't know about it,
 		# only the side effect of no returned value!
-		log_debug('Get (%s), type (%s), value(%s)' %
-					(property_name, str(type(value)), str(value)))
+		log_debug('Get (%s), type (%s), value(%s)',
+					args=(property_name, type(value), value))
 		return value
 
 	# Properties
@@ -136,9 +136,9 @@ class AutomatedProperties(dbus.service.Object):
 							signature='sa{sv}as')
 	def PropertiesChanged(self, interface_name, changed_properties,
 							invalidated_properties):
-		log_debug(('SIGNAL: PropertiesChanged(%s, %s, %s, %s)' %
-					(str(self._ap_o_path), str(interface_name),
-					str(changed_properties), str(invalidated_properties))))
+		log_debug('SIGNAL: PropertiesChanged(%s, %s, %s, %s)',
+					args=(self._ap_o_path, interface_name,
+					changed_properties, invalidated_properties))
 
 	def refresh(self, search_key=None, object_state=None):
 		"""
@@ -70,11 +70,13 @@ def common(retrieve, o_type, search_keys,
 
 		if return_object:
 			dbus_object = o.create_dbus_object(object_path)
-			cfg.om.register_object(dbus_object, emit_signal)
 			rc.append(dbus_object)
 
 		object_path = None
 
+	# Register all the new objects in one go
+	cfg.om.register_objects(rc, emit_signal)
+
 	to_remove = []
 	if refresh:
 		to_remove = list(existing_paths.keys())
@@ -142,9 +142,7 @@ class Manager(AutomatedProperties):
 
 	@staticmethod
 	def _lookup_by_lvm_id(key):
-		p = cfg.om.get_object_path_by_uuid_lvm_id(key, key)
-		if not p:
-			p = '/'
+		p = cfg.om.get_object_path_by_lvm_id(key)
 		utils.log_debug('LookUpByLvmId: key = %s, result = %s' % (key, p))
 		return p
 
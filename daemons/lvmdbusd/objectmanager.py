@@ -8,14 +8,35 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import sys
-import threading
 import dbus
 import os
-import copy
 from . import cfg
-from .utils import log_debug, pv_obj_path_generate, log_error, extract_stack_trace
+from .utils import log_debug, pv_obj_path_generate, log_error, \
+	extract_stack_trace, RWLock
 from .automatedproperties import AutomatedProperties
 
+# Max. number of device paths we keep the canonical form for
+_REALPATH_CACHE_MAX = 1024
+
+
+def _intern(key):
+	# sys.intern() only takes str, not subclasses like dbus.String
+	if type(key) is str:
+		return sys.intern(key)
+	return key
+
+
+def _lvm_id_alias(lvm_id):
+	"""
+	Hidden LVs have a lvm_id of vg/[lv], but users look them up as vg/lv
+	:param lvm_id:  The lvm id for the asset
+	:return: The vg/lv alias for a hidden LV, otherwise None
+	"""
+	vg, sep, lv = lvm_id.partition('/')
+	if sep and lv.startswith('[') and lv.endswith(']'):
+		return vg + '/' + lv[1:-1]
+	return None
+
 
 # noinspection PyPep8Naming
 class ObjectManager(AutomatedProperties):
@@ -27,22 +48,38 @@ class ObjectManager(AutomatedProperties):
 		super(ObjectManager, self).__init__(object_path, interface)
 		self.set_interface(interface)
 		self._ap_o_path = object_path
-		self._objects = {}
-		self._id_to_object_path = {}
-		self.rlock = threading.RLock()
+		# Object path keyed tables, one for each piece of information we
+		# keep about a registered object
+		self._path_to_obj = {}
+		self._path_to_lvm_id = {}
+		self._path_to_uuid = {}
+		# Object paths grouped by the type of the registered object
+		self._type_to_paths = {}
+		# Device path to canonical device path, only valid until the set of
+		# PVs changes
+		self._realpath_cache = {}
+		# Separate id tables, so a uuid can never match a lvm_id
+		self._uuid_to_path = {}
+		self._lvm_id_to_path = {}
+		self.rwlock = RWLock()
 
 	@staticmethod
 	def _get_managed_objects(obj):
-		with obj.rlock:
-			rc = {}
-			try:
-				for k, v in list(obj._objects.items()):
-					path, props = v[0].emit_data()
-					rc[path] = props
-			except Exception as e:
-				log_error("_get_managed_objects exception, bailing: \n%s" % extract_stack_trace(e))
-				sys.exit(1)
-			return rc
+		# Only take a snapshot of the objects under the lock, gathering the
+		# properties of every object takes a while and can call back into
+		# the object manager.
+		with obj.rwlock.read_locked():
+			objects = list(obj._path_to_obj.values())
+
+		rc = {}
+		try:
+			for o in objects:
+				path, props = o.emit_data()
+				rc[path] = props
+		except Exception as e:
+			log_error("_get_managed_objects exception, bailing: \n%s" % extract_stack_trace(e))
+			sys.exit(1)
+		return rc
 
 	@dbus.service.method(
 		dbus_interface="org.freedesktop.DBus.ObjectManager",
@@ -56,40 +93,47 @@ class ObjectManager(AutomatedProperties):
 		dbus_interface="org.freedesktop.DBus.ObjectManager",
 		signature='oa{sa{sv}}')
 	def InterfacesAdded(self, object_path, int_name_prop_dict):
-		log_debug(
-			('SIGNAL: InterfacesAdded(%s, %s)' %
-			(str(object_path), str(int_name_prop_dict))))
+		log_debug('SIGNAL: InterfacesAdded(%s, %s)',
+			args=(object_path, int_name_prop_dict))
 
 	@dbus.service.signal(
 		dbus_interface="org.freedesktop.DBus.ObjectManager",
 		signature='oas')
 	def InterfacesRemoved(self, object_path, interface_list):
-		log_debug(('SIGNAL: InterfacesRemoved(%s, %s)' %
-			(str(object_path), str(interface_list))))
+		log_debug('SIGNAL: InterfacesRemoved(%s, %s)',
+			args=(object_path, interface_list))
 
 	def validate_lookups(self):
-		with self.rlock:
-			tmp_lookups = copy.deepcopy(self._id_to_object_path)
+		with self.rwlock.read_locked():
+			# Keys and values are strings, a shallow copy is all we need
+			tmp_lvm_ids = self._lvm_id_to_path.copy()
+			tmp_uuids = self._uuid_to_path.copy()
 
 			# iterate over all we know, removing from the copy.  If all is well
 			# we will have zero items left over
-			for path, md in self._objects.items():
-				obj, lvm_id, uuid = md
+			for path, lvm_id in self._path_to_lvm_id.items():
+				uuid = self._path_to_uuid[path]
 
 				if lvm_id:
-					assert path == tmp_lookups[lvm_id]
-					del tmp_lookups[lvm_id]
+					assert path == tmp_lvm_ids[lvm_id]
+					del tmp_lvm_ids[lvm_id]
+
+					alias = _lvm_id_alias(lvm_id)
+					if alias and tmp_lvm_ids.get(alias) == path:
+						del tmp_lvm_ids[alias]
 
 				if uuid:
-					assert path == tmp_lookups[uuid]
-					del tmp_lookups[uuid]
+					assert path == tmp_uuids[uuid]
+					del tmp_uuids[uuid]
 
-			rc = len(tmp_lookups)
+			rc = len(tmp_lvm_ids) + len(tmp_uuids)
 			if rc:
 				# Error condition
-				log_error("_id_to_object_path has extraneous lookups!")
-				for key, path in tmp_lookups.items():
-					log_error("Key= %s, path= %s" % (key, path))
+				log_error("id lookups have extraneous entries!")
+				for key, path in tmp_lvm_ids.items():
+					log_error("lvm_id= %s, path= %s" % (key, path))
+				for key, path in tmp_uuids.items():
+					log_error("uuid= %s, path= %s" % (key, path))
 		return rc
 
 	def _lookup_add(self, obj, path, lvm_id, uuid):
@@ -101,50 +145,105 @@ class ObjectManager(AutomatedProperties):
 		:param uuid:    The uuid for the asset
 		:return:
 		"""
-		# Note: Only called internally, lock implied
-
-		# We could have a temp entry from the forward creation of a path
-		self._lookup_remove(path)
+		# Note: Only called internally, write lock implied
 
-		self._objects[path] = (obj, lvm_id, uuid)
+		# The same strings end up as keys and values in several tables
+		path = _intern(path)
+		lvm_id = _intern(lvm_id)
+		uuid = _intern(uuid)
 
 		# Make sure we have one or the other
 		assert lvm_id or uuid
 
+		# Lookups by id and path don't take the lock, so we add the new
+		# entries before dropping the ones left over from what was stored
+		# for the path before, e.g. a temp entry from the forward creation
+		# of a path or the old name of a renamed asset.
+		old_obj = self._path_to_obj.get(path)
+		old_lvm_id = self._path_to_lvm_id.get(path)
+		old_uuid = self._path_to_uuid.get(path)
+
+		if path.startswith(cfg.PV_OBJ_PATH):
+			self._realpath_cache.clear()
+
+		self._path_to_obj[path] = obj
+		self._path_to_lvm_id[path] = lvm_id
+		self._path_to_uuid[path] = uuid
+
+		if old_obj is not obj:
+			self._type_remove(old_obj, path)
+			if obj is not None:
+				self._type_to_paths.setdefault(type(obj), set()).add(path)
+
+		lvm_id_map = self._lvm_id_to_path
+		alias = None
 		if lvm_id:
-			self._id_to_object_path[lvm_id] = path
+			lvm_id_map[lvm_id] = path
+
+			# Add the name without brackets for hidden LVs too, so we don't
+			# have to build the bracketed name on every lookup
+			alias = _lvm_id_alias(lvm_id)
+			if alias and alias not in lvm_id_map:
+				lvm_id_map[alias] = path
 
 		if uuid:
-			self._id_to_object_path[uuid] = path
+			self._uuid_to_path[uuid] = path
 
-	def _lookup_remove(self, obj_path):
-		# Note: Only called internally, lock implied
-		if obj_path in self._objects:
-			(obj, lvm_id, uuid) = self._objects[obj_path]
+		self._ids_remove(path, old_lvm_id, old_uuid, (lvm_id, alias), (uuid,))
+
+	def _type_remove(self, obj, obj_path):
+		# Note: Only called internally, write lock implied
+		if obj is not None:
+			paths = self._type_to_paths[type(obj)]
+			paths.discard(obj_path)
+			if not paths:
+				del self._type_to_paths[type(obj)]
+
+	def _ids_remove(self, obj_path, lvm_id, uuid, keep_lvm_ids=(),
+					keep_uuids=()):
+		# Note: Only called internally, write lock implied
+		lvm_id_map = self._lvm_id_to_path
+
+		if lvm_id and lvm_id not in keep_lvm_ids:
+			lvm_id_map.pop(lvm_id, None)
+
+		if lvm_id:
+			alias = _lvm_id_alias(lvm_id)
+			if alias and alias not in keep_lvm_ids and \
+					lvm_id_map.get(alias) == obj_path:
+				del lvm_id_map[alias]
+
+		if uuid and uuid not in keep_uuids:
+			self._uuid_to_path.pop(uuid, None)
 
-			if lvm_id in self._id_to_object_path:
-				del self._id_to_object_path[lvm_id]
+	def _lookup_remove(self, obj_path):
+		# Note: Only called internally, write lock implied
+		if obj_path in self._path_to_obj:
+			self._type_remove(self._path_to_obj.pop(obj_path), obj_path)
+			lvm_id = self._path_to_lvm_id.pop(obj_path)
+			uuid = self._path_to_uuid.pop(obj_path)
 
-			if uuid in self._id_to_object_path:
-				del self._id_to_object_path[uuid]
+			self._ids_remove(obj_path, lvm_id, uuid)
 
-			del self._objects[obj_path]
+			if obj_path.startswith(cfg.PV_OBJ_PATH):
+				self._realpath_cache.clear()
 
 	def lookup_update(self, dbus_obj, new_uuid, new_lvm_id):
-		with self.rlock:
-			obj_path = dbus_obj.dbus_object_path()
-			self._lookup_remove(obj_path)
+		with self.rwlock.write_locked():
+			# _lookup_add replaces what we had for the path
 			self._lookup_add(
-				dbus_obj, obj_path,
+				dbus_obj, dbus_obj.dbus_object_path(),
 				new_lvm_id, new_uuid)
 
 	def object_paths_by_type(self, o_type):
-		with self.rlock:
+		with self.rwlock.read_locked():
 			rc = {}
 
-			for k, v in list(self._objects.items()):
-				if isinstance(v[0], o_type):
-					rc[k] = True
+			# Only a handful of types are ever registered, so checking each
+			# of them is much cheaper than checking every object
+			for t, paths in self._type_to_paths.items():
+				if issubclass(t, o_type):
+					rc.update(dict.fromkeys(paths, True))
 			return rc
 
 	def register_object(self, dbus_object, emit_signal=False):
@@ -153,18 +252,29 @@ class ObjectManager(AutomatedProperties):
 		:param dbus_object: Dbus object to register
 		:param emit_signal: If true emit a signal for interfaces added
 		"""
-		with self.rlock:
-			path, props = dbus_object.emit_data()
-
-			# print('Registering object path %s for %s' %
-			# (path, dbus_object.lvm_id))
+		self.register_objects((dbus_object,), emit_signal)
 
-			# We want fast access to the object by a number of different ways
-			# so we use multiple hashs with different keys
-			self._lookup_add(dbus_object, path, dbus_object.lvm_id,
-				dbus_object.Uuid)
-
-			if emit_signal:
+	def register_objects(self, dbus_objects, emit_signal=False):
+		"""
+		Given dbus objects add them to the collection, taking the lock once
+		for all of them
+		:param dbus_objects: Dbus objects to register
+		:param emit_signal: If true emit a signal for interfaces added
+		"""
+		# We want fast access to the object by a number of different ways
+		# so we use multiple hashs with different keys
+		with self.rwlock.write_locked():
+			for dbus_object in dbus_objects:
+				# print('Registering object path %s for %s' %
+				# (dbus_object.dbus_object_path(), dbus_object.lvm_id))
+				self._lookup_add(dbus_object, dbus_object.dbus_object_path(),
+					dbus_object.lvm_id, dbus_object.Uuid)
+
+		# Gathering the properties is expensive and can call back into the
+		# object manager, so do it without the lock and only if needed
+		if emit_signal:
+			for dbus_object in dbus_objects:
+				path, props = dbus_object.emit_data()
 				self.InterfacesAdded(path, props)
 
 	def remove_object(self, dbus_object, emit_signal=False):
@@ -174,22 +284,31 @@ class ObjectManager(AutomatedProperties):
 		:param dbus_object:  Dbus object to remove
 		:param emit_signal:  If true emit the interfaces removed signal
 		"""
-		with self.rlock:
-			# Store off the object path and the interface first
-			path = dbus_object.dbus_object_path()
-			interfaces = dbus_object.interface()
-
-			# print('UN-Registering object path %s for %s' %
-			#		(path, dbus_object.lvm_id))
+		self.remove_objects((dbus_object,), emit_signal)
 
-			self._lookup_remove(path)
+	def remove_objects(self, dbus_objects, emit_signal=False):
+		"""
+		Given dbus objects, remove them from the collection and remove them
+		from the dbus framework as well, taking the lock once for all of them
+		:param dbus_objects: Dbus objects to remove
+		:param emit_signal:  If true emit the interfaces removed signal
+		"""
+		# Only the lookups need the lock, the dbus library has its own
+		with self.rwlock.write_locked():
+			for dbus_object in dbus_objects:
+				# print('UN-Registering object path %s for %s' %
+				#		(dbus_object.dbus_object_path(), dbus_object.lvm_id))
+				self._lookup_remove(dbus_object.dbus_object_path())
+
+		for dbus_object in dbus_objects:
+			path = dbus_object.dbus_object_path()
 
 			# Remove from dbus library
 			dbus_object.remove_from_connection(cfg.bus, path)
 
 			# Optionally emit a signal
 			if emit_signal:
-				self.InterfacesRemoved(path, interfaces)
+				self.InterfacesRemoved(path, dbus_object.interface())
 
 	def get_object_by_path(self, path):
 		"""
@@ -197,26 +316,26 @@ class ObjectManager(AutomatedProperties):
 		:param path: The dbus path
 		:return: The object
 		"""
-		with self.rlock:
-			if path in self._objects:
-				return self._objects[path][0]
-			return None
+		# A single dict lookup, doesn't need the lock
+		return self._path_to_obj.get(path)
 
 	def get_object_by_uuid_lvm_id(self, uuid, lvm_id):
-		with self.rlock:
-			return self.get_object_by_path(
-				self.get_object_path_by_uuid_lvm_id(uuid, lvm_id))
+		assert lvm_id
+		assert uuid
+
+		with self.rwlock.read_locked():
+			path = self._get_object_path_by_uuid_lvm_id(uuid, lvm_id, None)
+			return self._path_to_obj.get(path)
 
 	def get_object_by_lvm_id(self, lvm_id):
 		"""
 		Given an lvm identifier, return the object registered for it
 		:param lvm_id: The lvm identifier
 		"""
-		with self.rlock:
-			lookup_rc = self._id_lookup(lvm_id)
-			if lookup_rc:
-				return self.get_object_by_path(lookup_rc)
-			return None
+		lookup_rc = self._id_lookup(lvm_id)
+		if lookup_rc:
+			return self._path_to_obj.get(lookup_rc)
+		return None
 
 	def get_object_path_by_lvm_id(self, lvm_id):
 		"""
@@ -224,16 +343,12 @@ class ObjectManager(AutomatedProperties):
 		:param lvm_id: The lvm identifier
 		:return: Object path or '/' if not found
 		"""
-		with self.rlock:
-			lookup_rc = self._id_lookup(lvm_id)
-			if lookup_rc:
-				return lookup_rc
-			return '/'
+		return self._id_lookup(lvm_id) or '/'
 
 	def _id_verify(self, path, uuid, lvm_id):
 		"""
 		Ensure our lookups are correct
-		NOTE: Internal call, assumes under object manager lock
+		NOTE: Internal call, assumes under object manager write lock
 		:param path: 		Path to object we looked up
 		:param uuid: 		uuid lookup
 		:param lvm_id:		lvm_id lookup
@@ -241,30 +356,61 @@ class ObjectManager(AutomatedProperties):
 		"""
 		# There is no durable non-changeable name in lvm
 		if lvm_id != uuid:
-			obj = self.get_object_by_path(path)
+			obj = self._path_to_obj.get(path)
 			self._lookup_add(obj, path, lvm_id, uuid)
 
-	def _id_lookup(self, the_id):
-		path = None
+	def _id_current(self, path, uuid, lvm_id):
+		"""
+		Check if _id_verify would leave the lookups unchanged
+		NOTE: Internal call, assumes under object manager lock
+		:param path: 		Path to object we looked up
+		:param uuid: 		uuid lookup
+		:param lvm_id:		lvm_id lookup
+		:return: True if the lookups are already correct
+		"""
+		if lvm_id == uuid:
+			return True
+
+		if self._path_to_lvm_id.get(path) != lvm_id or \
+				self._path_to_uuid.get(path) != uuid:
+			return False
+
+		if lvm_id and self._lvm_id_to_path.get(lvm_id) != path:
+			return False
+		return self._uuid_to_path.get(uuid) == path
+
+	def _realpath(self, device):
+		# os.path.realpath() does a lstat for every path component, so
+		# remember what we got.  The cache is only cleared when full as we
+		# can get here holding just the read lock.
+		canonical = self._realpath_cache.get(device)
+		if canonical is None:
+			canonical = os.path.realpath(device)
+			if len(self._realpath_cache) >= _REALPATH_CACHE_MAX:
+				self._realpath_cache.clear()
+			self._realpath_cache[device] = canonical
+		return canonical
+
+	# Note: The lookup functions below can be called without the lock,
+	# writers keep each of the tables valid on its own at all times
+
+	def _lvm_id_lookup(self, lvm_id):
+		# Nearly every lookup is answered right here
+		lvm_id_map = self._lvm_id_to_path
+		path = lvm_id_map.get(lvm_id)
+		if path is not None or not lvm_id or lvm_id[0] != '/':
+			return path
 
-		if the_id:
-			# The _id_to_object_path contains hash keys for everything, so
-			# uuid and lvm_id
-			if the_id in self._id_to_object_path:
-				path = self._id_to_object_path[the_id]
-			else:
-				if "/" in the_id:
-					if the_id.startswith('/'):
-						# We could have a pv device path lookup that failed,
-						# lets try canonical form and try again.
-						canonical = os.path.realpath(the_id)
-						if canonical in self._id_to_object_path:
-							path = self._id_to_object_path[canonical]
-					else:
-						vg, lv = the_id.split("/", 1)
-						int_lvm_id = vg + "/" + ("[%s]" % lv)
-						if int_lvm_id in self._id_to_object_path:
-							path = self._id_to_object_path[int_lvm_id]
+		# We could have a pv device path lookup that failed,
+		# lets try canonical form and try again.
+		return lvm_id_map.get(self._realpath(lvm_id))
+
+	def _id_lookup(self, the_id):
+		# For when we don't know if we have a lvm_id or a uuid, lvm_ids
+		# are far more common
+		path = self._lvm_id_lookup(the_id)
+		if path is None:
+			path = self._uuid_to_path.get(the_id)
 		return path
 
 	def get_object_path_by_uuid_lvm_id(self, uuid, lvm_id, path_create=None):
@@ -283,44 +429,70 @@ class ObjectManager(AutomatedProperties):
 		:returns None if lvm asset not found and path_create == None otherwise
 				a valid dbus object path
 		"""
-		with self.rlock:
-			assert lvm_id
-			assert uuid
+		# Fast path for a Manager.LookUpByLvmId style query, there is
+		# nothing to verify or create
+		if uuid == lvm_id and not path_create:
+			return self._id_lookup(lvm_id)
+
+		assert lvm_id
+		assert uuid
+
+		if path_create:
+			assert uuid != lvm_id
+
+		with self.rwlock.read_locked():
+			return self._get_object_path_by_uuid_lvm_id(
+				uuid, lvm_id, path_create)
 
-			if path_create:
-				assert uuid != lvm_id
+	def _get_object_path_by_uuid_lvm_id(self, uuid, lvm_id, path_create):
+		"""
+		See get_object_path_by_uuid_lvm_id
+		NOTE: Internal call, assumes under object manager read lock, takes the
+		write lock if the lookups need to be updated
+		"""
+		# Check for Manager.LookUpByLvmId query, we cannot
+		# check/verify/update the uuid and lvm_id lookups so don't!
+		if uuid == lvm_id:
+			return self._id_lookup(lvm_id)
+
+		# We have a uuid and a lvm_id we can do sanity checks to ensure
+		# that they are consistent
+
+		# If a PV is missing its device path is '[unknown]' or some
+		# other text derivation of unknown.  When we find that a PV is
+		# missing we will clear out the lvm_id as it's not unique
+		# and thus not useful and harmful for lookups.
+		if cfg.db.pv_missing(uuid):
+			lvm_id = None
+
+		# Common case, found and the lookups are already correct, which
+		# only needs the read lock
+		path = self._uuid_to_path.get(uuid) or self._lvm_id_lookup(lvm_id)
+		if path:
+			if self._id_current(path, uuid, lvm_id):
+				return path
+		elif not path_create:
+			return None
 
-			# Check for Manager.LookUpByLvmId query, we cannot
-			# check/verify/update the uuid and lvm_id lookups so don't!
-			if uuid == lvm_id:
-				path = self._id_lookup(lvm_id)
+		# We need to update the lookups, re-do the lookup under the write
+		# lock as things could have changed while we waited for it
+		with self.rwlock.write_locked():
+			# Lets check for the uuid first
+			path = self._uuid_to_path.get(uuid)
+			if path:
+				# Ensure table lookups are correct
+				self._id_verify(path, uuid, lvm_id)
 			else:
-				# We have a uuid and a lvm_id we can do sanity checks to ensure
-				# that they are consistent
-
-				# If a PV is missing its device path is '[unknown]' or some
-				# other text derivation of unknown.  When we find that a PV is
-				# missing we will clear out the lvm_id as it's not unique
-				# and thus not useful and harmful for lookups.
-				if cfg.db.pv_missing(uuid):
-					lvm_id = None
-
-				# Lets check for the uuid first
-				path = self._id_lookup(uuid)
+				# Unable to find by UUID, lets lookup by lvm_id
+				path = self._lvm_id_lookup(lvm_id)
 				if path:
 					# Ensure table lookups are correct
 					self._id_verify(path, uuid, lvm_id)
 				else:
-					# Unable to find by UUID, lets lookup by lvm_id
-					path = self._id_lookup(lvm_id)
-					if path:
-						# Ensure table lookups are correct
-						self._id_verify(path, uuid, lvm_id)
-					else:
-						# We have exhausted all lookups, let's create if we can
-						if path_create:
-							path = path_create()
-							self._lookup_add(None, path, lvm_id, uuid)
+					# We have exhausted all lookups, let's create if we can
+					if path_create:
+						path = path_create()
+						self._lookup_add(None, path, lvm_id, uuid)
 
 			# print('get_object_path_by_lvm_id(%s, %s, %s): return %s' %
 			#	(uuid, lvm_id, str(path_create), path))
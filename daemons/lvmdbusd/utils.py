@@ -305,21 +305,35 @@ class DebugMessages(object):
 					self.queue.clear()
 
 
-def _format_log_entry(msg):
+def _log_entry_prefix():
 	tid = ctypes.CDLL('libc.so.6').syscall(186)
 
 	if not cfg.systemd and STDOUT_TTY:
-		msg = "%s: %d:%d - %s" % \
+		return "%s: %d:%d - " % \
 			(datetime.datetime.now().strftime("%b %d %H:%M:%S.%f"),
-			os.getpid(), tid, msg)
+			os.getpid(), tid)
 
-	else:
-		if cfg.systemd:
-			# Systemd already puts the daemon pid in the log, we'll just add the tid
-			msg = "[%d]: %s" % (tid, msg)
-		else:
-			msg = "[%d:%d]: %s" % (os.getpid(), tid, msg)
-	return msg
+	if cfg.systemd:
+		# Systemd already puts the daemon pid in the log, we'll just add the tid
+		return "[%d]: " % tid
+	return "[%d:%d]: " % (os.getpid(), tid)
+
+
+def _format_log_entry(msg):
+	return _log_entry_prefix() + msg
+
+
+# Debug message which is only formatted when it gets output, the arguments
+# can be expensive to turn into strings and most messages are never output.
+class _LazyLogEntry(object):
+
+	def __init__(self, prefix, msg, args):
+		self.prefix = prefix
+		self.msg = msg
+		self.args = args
+
+	def __str__(self):
+		return self.prefix + (self.msg % self.args)
 
 
 def _common_log(msg, *attributes):
@@ -337,13 +351,20 @@ def _common_log(msg, *attributes):
 
 # Serializes access to stdout to prevent interleaved output
 # @param msg    Message to output to stdout
+# @param args   If not None, msg is a format string for args, which is only
+#               formatted if the message is output
 # @return None
-def log_debug(msg, *attributes):
+def log_debug(msg, *attributes, args=None):
 	if cfg.args and cfg.args.debug:
+		if args is not None:
+			msg = msg % args
 		_common_log(msg, *attributes)
 	else:
 		if cfg.debug:
-			cfg.debug.add(_format_log_entry(msg))
+			if args is not None:
+				cfg.debug.add(_LazyLogEntry(_log_entry_prefix(), msg, args))
+			else:
+				cfg.debug.add(_format_log_entry(msg))
 
 
 def log_error(msg, *attributes):
@@ -736,9 +757,119 @@ class MThreadRunner(object):
 			self.exception = be
 
 
+class _LockContext(object):
+
+	def __init__(self, acquire, release):
+		self.acquire = acquire
+		self.release = release
+
+	def __enter__(self):
+		self.acquire()
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.release()
+
+
+# Reader/writer lock, any number of threads can hold the read lock at the same
+# time, the write lock is exclusive.  Both sides are re-entrant: a thread
+# holding the write lock may also take the read lock and a thread may take the
+# read lock recursively.  A reader which asks for the write lock gives up its
+# read hold while waiting and gets it back when the write lock is released.
+class RWLock(object):
+
+	def __init__(self):
+		self._cond = threading.Condition(threading.Lock())
+		self._readers = 0
+		self._writer = None
+		self._writer_depth = 0
+		self._writers_waiting = 0
+		self._upgraded_depth = 0
+		# Per thread read recursion count, lets recursive readers skip
+		# the condition entirely
+		self._local = threading.local()
+		# Context managers are created once, not on every use
+		self._read_locked = _LockContext(self.acquire_read, self.release_read)
+		self._write_locked = _LockContext(
+			self.acquire_write, self.release_write)
+
+	def acquire_read(self):
+		me = threading.get_ident()
+		if self._writer == me:
+			self._writer_depth += 1
+			return
+
+		tl = self._local
+		depth = getattr(tl, 'depth', 0)
+		if depth:
+			tl.depth = depth + 1
+			return
+
+		with self._cond:
+			# Writers waiting take precedence over new readers
+			while self._writer is not None or self._writers_waiting:
+				self._cond.wait()
+			self._readers += 1
+		tl.depth = 1
+
+	def release_read(self):
+		if self._writer == threading.get_ident():
+			self._writer_depth -= 1
+			return
+
+		tl = self._local
+		tl.depth -= 1
+		if not tl.depth:
+			with self._cond:
+				self._readers -= 1
+				if not self._readers:
+					self._cond.notify_all()
+
+	def acquire_write(self):
+		me = threading.get_ident()
+		if self._writer == me:
+			self._writer_depth += 1
+			return
+
+		tl = self._local
+		held = getattr(tl, 'depth', 0)
+		with self._cond:
+			if held:
+				self._readers -= 1
+				if not self._readers:
+					self._cond.notify_all()
+			self._writers_waiting += 1
+			while self._writer is not None or self._readers:
+				self._cond.wait()
+			self._writers_waiting -= 1
+			self._writer = me
+			self._writer_depth = 1
+			self._upgraded_depth = held
+		tl.depth = 0
+
+	def release_write(self):
+		self._writer_depth -= 1
+		if self._writer_depth:
+			return
+
+		with self._cond:
+			held = self._upgraded_depth
+			self._upgraded_depth = 0
+			self._writer = None
+			if held:
+				# Hand the read lock back before anyone else gets in
+				self._readers += 1
+				self._local.depth = held
+			self._cond.notify_all()
+
+	def read_locked(self):
+		return self._read_locked
+
+	def write_locked(self):
+		return self._write_locked
+
+
 def _remove_objects(dbus_objects_rm):
-	for o in dbus_objects_rm:
-		cfg.om.remove_object(o, emit_signal=True)
+	cfg.om.remove_objects(dbus_objects_rm, emit_signal=True)
 
 
 # Remove dbus objects from main thread